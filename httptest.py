@@ -6,16 +6,21 @@ import select
 import socket
 import sys
 import time
-from collections import Iterable
+from collections import Iterable, defaultdict, deque
 from io import BytesIO
-from threading import Event, Thread
+from threading import Lock, Thread
 from wsgiref.handlers import format_date_time
 from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
 
 try:
-    from queue import Empty, Queue
+    import selectors
 except ImportError:
-    from Queue import Empty, Queue
+    selectors = None
+
+try:
+    from socketserver import TCPServer, ThreadingMixIn
+except ImportError:
+    from SocketServer import TCPServer, ThreadingMixIn
 
 try:
     xrange
@@ -29,6 +34,8 @@ _reuseaddress = os.name != 'nt'
 class TestRequest(object):
     """A request made to the test server"""
 
+    __slots__ = ('method', 'protocol', 'address', 'path', 'headers', 'body')
+
     def __init__(self, method=None, protocol=None, address=None, path=None,
                  headers=None, body=None):
         self.method = method
@@ -41,30 +48,75 @@ class TestRequest(object):
 class TestResponse(object):
     """A response from the test server"""
 
+    __slots__ = ('status', 'headers', 'body')
+
     def __init__(self, status=None, headers=None, body=None):
         self.status = status
         self.headers = headers
         self.body = body
 
-def _portavailable(host, port):
-    """Check if the given host and port are available to be bound to"""
+_fqdncache = {}
+
+def _getfqdn(host):
+    """Like socket.getfqdn(), but remembers the result for each host"""
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        if _reuseaddress:
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            sock.bind((host, port))
-        finally:
-            sock.close()
-    except socket.error as e:
-        if e.errno == errno.EADDRINUSE:
-            return False
-        raise
-    else:
-        return True
+        return _fqdncache[host]
+    except KeyError:
+        name = _fqdncache[host] = socket.getfqdn(host)
+        return name
+
+class _LogQueue(object):
+    """A bounded, thread-safe queue of (request, response) log entries.
+
+    Once maxsize entries are waiting to be collected, the oldest one is
+    discarded to make room for each new entry.
+    """
 
-class _TestWSGIServer(WSGIServer, object):
-    """Like WSGIServer, but supports shutdown via pipe"""
+    def __init__(self, maxsize=None):
+        self._entries = deque(maxlen=maxsize)
+        self._lock = Lock()
+        self.dropped = 0
+
+    def put(self, entry):
+        """Add an entry to the queue"""
+        with self._lock:
+            if len(self._entries) == self._entries.maxlen:
+                self.dropped += 1
+            self._entries.append(entry)
+
+    def drain(self):
+        """Remove and return all queued entries"""
+        with self._lock:
+            entries = self._entries
+            self._entries = deque(maxlen=entries.maxlen)
+        return entries
+
+def _socketpair():
+    """Return a connected pair of sockets.
+
+    This is socket.socketpair() where available. Otherwise (i.e., on
+    Windows before Python 3.5) the pair is emulated with TCP sockets over
+    the loopback interface.
+    """
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(listener.getsockname())
+        server = listener.accept()[0]
+    finally:
+        listener.close()
+    return server, client
+
+class _TestWSGIServer(ThreadingMixIn, WSGIServer, object):
+    """Like WSGIServer, but supports shutdown via socket and (unless
+    threaded is False) handles each request in its own thread so concurrent
+    requests aren't serialized.
+    """
 
     if os.name == 'nt':
         allow_reuse_address = _reuseaddress
@@ -73,14 +125,29 @@ class _TestWSGIServer(WSGIServer, object):
         """Initialize the test HTTP server.
 
         In addition to the arguments WSGIserver accepts, this also
-        requires a shutdownfd keyword argument. This should be a pipe file
-        descriptor that the caller will use to communicate when the server
-        should shut down.
+        requires a shutdownsock keyword argument. This should be one end of
+        a socket pair that the caller will use to communicate when the
+        server should shut down.
+
+        If the threaded keyword argument is False, requests are handled one
+        at a time in the serving thread.
         """
-        self._shutdownfd = kwargs.pop('shutdownfd')
+        self._shutdownsock = kwargs.pop('shutdownsock')
         self._ignorehangups = kwargs.pop('ignorehangups', False)
+        self._threaded = kwargs.pop('threaded', True)
+        self._requestthreads = []
         super(_TestWSGIServer, self).__init__(*args, **kwargs)
 
+    # This is WSGIServer.server_bind with HTTPServer.server_bind inlined so
+    # the reverse DNS lookup for server_name is only done once per host.
+    def server_bind(self):
+        """Bind the server socket and set up the WSGI environment"""
+        TCPServer.server_bind(self)
+        host, port = self.server_address[:2]
+        self.server_name = _getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+
     def handle_error(self, request, client_address):
         e = sys.exc_info()[1]
         if (self._ignorehangups and
@@ -89,29 +156,67 @@ class _TestWSGIServer(WSGIServer, object):
             return
         super(_TestWSGIServer, self).handle_error(request, client_address)
 
+    def process_request(self, request, client_address):
+        if not self._threaded:
+            TCPServer.process_request(self, request, client_address)
+            return
+
+        self._requestthreads = [t for t in self._requestthreads
+                                if t.is_alive()]
+        thread = Thread(target=self.process_request_thread,
+                        args=(request, client_address))
+        thread.daemon = True
+        thread.start()
+        self._requestthreads.append(thread)
+
+    def joinrequests(self):
+        """Wait for requests still being handled in other threads"""
+        for thread in self._requestthreads:
+            thread.join()
+
     def finish_request(self, request, client_address):
         self.RequestHandlerClass(request, client_address, self,
                                  ignorehangups=self._ignorehangups)
 
+    def _select(self):
+        """Wait for the server or shutdownsock to become readable using
+        select(), for Pythons without the selectors module.
+        """
+        while True:
+            try:
+                return select.select([self, self._shutdownsock], [], [])[0]
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+
     def serve_forever(self, poll_interval=None):
-        """Serve forever--or until told to shut down via the shutdownfd pipe"""
+        """Serve forever--or until told to shut down via shutdownsock"""
         if poll_interval is not None:
             raise ValueError('poll_interval is not supported')
 
-        while True:
+        if selectors is None:
+            selector = None
+            wait = self._select
+        else:
+            selector = selectors.DefaultSelector()
+            selector.register(self, selectors.EVENT_READ)
+            selector.register(self._shutdownsock, selectors.EVENT_READ)
+
+            def wait():
+                return [key.fileobj for key, _ in selector.select()]
+
+        try:
             while True:
-                try:
-                    fdsets = select.select([self, self._shutdownfd], [], [])
-                    break
-                except OSError as e:
-                    if e.errno != errno.EINTR:
-                        raise
+                ready = wait()
 
-            if self in fdsets[0]:
-                self._handle_request_noblock()
+                if self in ready:
+                    self._handle_request_noblock()
 
-            if self._shutdownfd in fdsets[0]:
-                break
+                if self._shutdownsock in ready:
+                    break
+        finally:
+            if selector is not None:
+                selector.close()
 
 class _TestServerHandler(ServerHandler, object):
     """Like ServerHandler, but supports suppressing logging of
@@ -130,7 +235,12 @@ class _TestServerHandler(ServerHandler, object):
         super(_TestServerHandler, self).handle_error()
 
 class _TestWSGIRequestHandler(WSGIRequestHandler, object):
-    """Like WSGIRequestHandler, but disables logging"""
+    """Like WSGIRequestHandler, but disables logging and Nagle's algorithm"""
+
+    # Send small responses right away instead of letting Nagle's algorithm
+    # and delayed ACKs hold them back.
+    disable_nagle_algorithm = True
+
     def __init__(self, *args, **kwargs):
         self._ignorehangups = kwargs.pop('ignorehangups', False)
         super(_TestWSGIRequestHandler, self).__init__(*args, **kwargs)
@@ -138,6 +248,37 @@ class _TestWSGIRequestHandler(WSGIRequestHandler, object):
     def log_request(self, code='-', size='-'):
         pass
 
+    def get_environ(self):
+        """Return the WSGI environ, with the request's headers also stored
+        as a list of (lowercased name, value) pairs under
+        'httptest.rawheaders'.
+        """
+        if not hasattr(self.headers, 'get_all'):
+            # Python 2's mimetools.Message keeps the continuation lines of
+            # folded headers as lines of their own, which can't be split into
+            # a name and value (here or in WSGIRequestHandler), so join them
+            # onto the header they continue first.
+            lines = []
+            for line in self.headers.headers:
+                if line[:1] not in (' ', '\t'):
+                    lines.append(line)
+                elif lines:
+                    lines[-1] = '%s %s\r\n' % (lines[-1].rstrip(),
+                                               line.strip())
+            self.headers.headers = lines
+
+        env = super(_TestWSGIRequestHandler, self).get_environ()
+        if hasattr(self.headers, 'get_all'):
+            items = self.headers.items()
+        else:
+            items = [h.split(':', 1) for h in self.headers.headers]
+        rawheaders = env['httptest.rawheaders'] = []
+        for key, value in items:
+            key = key.lower()
+            if key not in ('content-length', 'content-type'):
+                rawheaders.append((key, value.strip()))
+        return env
+
     # This is implementation is unforunately copied from WSGIRequestHandler
     # so we can override the hardcoded ServerHandler class it uses.
     def handle(self):
@@ -160,108 +301,262 @@ class _TestWSGIRequestHandler(WSGIRequestHandler, object):
         handler.request_handler = self      # backpointer for logging
         handler.run(self.server.get_app())
 
-def _logmiddleware(app, logqueue):
-    """Wrap WSGI app with a middleware that logs request and response
-    information to logqueue.
+_datecache = (None, None)
+
+def _httpdate():
+    """Return the current time formatted as an HTTP date.
+
+    The formatted string is cached for the rest of the second it was
+    generated in.
+    """
+    global _datecache
+    now = int(time.time())
+    cached = _datecache
+    if cached[0] != now:
+        cached = _datecache = (now, format_date_time(now))
+    return cached[1]
+
+class _TeeIterable(object):
+    """Wraps a WSGI response iterable, passing each chunk to record as
+    it's sent.
+
+    Once complete returns True (the declared Content-Length has been
+    recorded), finish is called before the chunk is handed to the server, so
+    the response is logged before the client can have received all of it.
+    Otherwise finish is called when the iterable is exhausted or closed,
+    which is before the server closes the connection.
+    """
+
+    def __init__(self, iterable, record, complete, finish):
+        self._iterable = iterable
+        self._record = record
+        self._complete = complete
+        self._finish = finish
+        self._finished = False
+
+    def _finishonce(self):
+        if not self._finished:
+            self._finished = True
+            self._finish()
+
+    def __iter__(self):
+        record = self._record
+        complete = self._complete
+        for chunk in self._iterable:
+            if not self._finished:
+                record(chunk)
+                if complete():
+                    self._finishonce()
+            yield chunk
+        self._finishonce()
+
+    def close(self):
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            self._finishonce()
+
+class _StartResponse(object):
+    """Wraps a request's start_response callable to record the response's
+    status, headers, and body for the log.
+
+    If capturebody is False, only the length of the body is kept.
     """
-    def wrapper(environ, start_response):
-        request = TestRequest()
-        response = TestResponse()
+
+    __slots__ = ('_start_response', '_write', '_logqueue', '_request',
+                 'status', 'headers', 'written', 'length', 'contentlength')
+
+    def __init__(self, start_response, logqueue, request, capturebody=True):
+        self._start_response = start_response
+        self._write = None
+        self._logqueue = logqueue
+        self._request = request
+        self.status = None
+        self.headers = defaultdict(list)
+        self.written = [] if capturebody else None
+        self.length = 0
+        self.contentlength = None
+
+    def __call__(self, status, headers, exc_info=None):
+        self.status = status
+        resheaders = self.headers
+        for key, value in headers:
+            resheaders[key.lower()].append(value)
         try:
-            request.method = environ['REQUEST_METHOD']
-            request.protocol = environ['SERVER_PROTOCOL']
-            request.address = environ['REMOTE_ADDR']
-
-            path = environ.get('SCRIPT_NAME') or '/'
-            pathinfo = environ.get('PATH_INFO', '')
-            if not environ.get('SCRIPT_NAME'):
-                path += pathinfo[1:]
+            self.contentlength = int(resheaders.get('content-length')[-1])
+        except (TypeError, ValueError):
+            self.contentlength = None
+
+        # Server-generated headers are passed on in a new list so the app's
+        # own list isn't modified.
+        extra = []
+        if 'date' not in resheaders:
+            date = _httpdate()
+            resheaders['date'].append(date)
+            extra.append(('Date', date))
+
+        if 'server' not in resheaders:
+            resheaders['server'].append('httptest')
+            extra.append(('Server', 'httptest'))
+
+        self._write = self._start_response(status, headers + extra, exc_info)
+        return self.write
+
+    def write(self, data):
+        self.record(data)
+        return self._write(data)
+
+    def record(self, data):
+        """Record a chunk of the response body"""
+        self.length += len(data)
+        if self.written is not None:
+            self.written.append(data)
+
+    def complete(self):
+        """Return whether the declared Content-Length has been recorded"""
+        return (self.contentlength is not None and
+                self.length >= self.contentlength)
+
+    # Entries are logged as flat tuples; TestServer.log() turns them into
+    # TestRequest/TestResponse objects when they're collected.
+    def log(self, headers=None, body=None):
+        """Log the request along with the given response headers/body"""
+        self._logqueue.put(self._request + (self.status, headers, body))
+
+    def finish(self):
+        """Log the request and the complete response"""
+        resbody = None if self.written is None else b''.join(self.written)
+        headers = {key: ','.join(values)
+                   for key, values in self.headers.items()}
+        if 'content-length' not in headers:
+            headers['content-length'] = str(self.length)
+        self.log(headers, resbody)
+
+class _LogMiddleware(object):
+    """Wraps a WSGI app and logs request and response information to
+    logqueue.
+
+    Request bodies longer than maxbodysize bytes aren't logged and are left
+    for the app to read straight from the client. Response bodies are only
+    logged if capturebody is True.
+    """
+
+    __slots__ = ('_app', '_logqueue', '_maxbodysize', '_capturebody')
+
+    def __init__(self, app, logqueue, maxbodysize=None, capturebody=True):
+        self._app = app
+        self._logqueue = logqueue
+        self._maxbodysize = maxbodysize
+        self._capturebody = capturebody
+
+    def __call__(self, environ, start_response):
+        method = protocol = address = path = reqheaders = reqbody = None
+        wrapper = None
+        getenv = environ.get
+        try:
+            method = environ['REQUEST_METHOD']
+            protocol = environ['SERVER_PROTOCOL']
+            address = environ['REMOTE_ADDR']
+
+            scriptname = getenv('SCRIPT_NAME')
+            pathinfo = getenv('PATH_INFO', '')
+            if scriptname:
+                path = scriptname + pathinfo
             else:
-                path += pathinfo
-            querystring = environ.get('QUERY_STRING')
+                path = '/' + pathinfo[1:]
+            querystring = getenv('QUERY_STRING')
             if querystring:
                 path += '?' + querystring
-            request.path = path
 
-            rawlength = environ.get('CONTENT_LENGTH')
+            rawlength = getenv('CONTENT_LENGTH')
             if rawlength and rawlength.isdigit():
                 length = int(rawlength)
             else:
                 length = -1
-            if length > 0:
-                request.body = environ['wsgi.input'].read(length)
-                environ['wsgi.input'] = BytesIO(request.body)
-            else:
-                request.body = None
-
-            reqheaders = {}
-            contenttype = environ.get('CONTENT_TYPE')
+            maxbodysize = self._maxbodysize
+            if length > 0 and (maxbodysize is None or length <= maxbodysize):
+                reqbody = environ['wsgi.input'].read(length)
+                environ['wsgi.input'] = BytesIO(reqbody)
+
+            rawheaders = defaultdict(list)
+            for key, value in environ['httptest.rawheaders']:
+                rawheaders[key].append(value)
+            headers = {key: ','.join(values)
+                       for key, values in rawheaders.items()}
+            contenttype = getenv('CONTENT_TYPE')
             if rawlength:
-                reqheaders['content-length'] = rawlength
+                headers['content-length'] = rawlength
             if contenttype:
-                reqheaders['content-type'] = contenttype
-            for key, value in environ.items():
-                if key.startswith('HTTP_'):
-                    key = key[5:].replace('_', '-').lower()
-                    reqheaders[key] = value
-            request.headers = reqheaders
-
-            resheaders = {}
-            written = []
-            def start_response_wrapper(status, headers, exc_info=None):
-                write = start_response(status, headers, exc_info)
-
-                response.status = status
-                for key, value in headers:
-                    key = key.lower()
-                    if key in resheaders:
-                        resheaders[key] += ',' + value
-                    else:
-                        resheaders[key] = value
-
-                if 'date' not in resheaders:
-                    date = format_date_time(time.time())
-                    resheaders['date'] = date
-                    headers.append(('Date', date))
-
-                if 'server' not in resheaders:
-                    server = 'httptest'
-                    resheaders['server'] = server
-                    headers.append(('Server', server))
-
-                def write_wrapper(data):
-                    written.append(data)
-                    return write(data)
-                return write_wrapper
-
-            out = list(app(environ, start_response_wrapper))
-            resbody = b''.join(written) + b''.join(out)
-            if 'content-length' not in resheaders:
-                resheaders['content-length'] = str(len(resbody))
-
-            response.headers = resheaders
-            response.body = resbody
-
+                headers['content-type'] = contenttype
+            reqheaders = headers
+
+            wrapper = _StartResponse(start_response, self._logqueue,
+                                     (method, protocol, address, path,
+                                      reqheaders, reqbody),
+                                     self._capturebody)
+            out = self._app(environ, wrapper)
+        except BaseException:
+            if wrapper is None:
+                self._logqueue.put((method, protocol, address, path,
+                                    reqheaders, reqbody, None, None, None))
+            else:
+                wrapper.log()
+            raise
+
+        # Sized results are returned as is so the server can still work out
+        # Content-Length on its own.
+        if isinstance(out, (list, tuple)):
+            for chunk in out:
+                wrapper.record(chunk)
+            wrapper.finish()
             return out
-        finally:
-            logqueue.put((request, response))
-    return wrapper
+        return _TeeIterable(out, wrapper.record, wrapper.complete,
+                            wrapper.finish)
 
 def nocontent(environ, start_response):
     start_response('204 No Content', [])
     return [b'']
 
-def _makeserver(host, port, app, logqueue, start, shutdownfd,
-                ignorehangups=False):
-    httpd = _TestWSGIServer((host, port), _TestWSGIRequestHandler,
-                            shutdownfd=shutdownfd,
-                            ignorehangups=ignorehangups)
-    httpd.set_app(_logmiddleware(app, logqueue))
-    start.set()
+def _makeserver(host, port, app, logqueue, shutdownsock,
+                ignorehangups=False, capturelog=True, maxbodysize=None,
+                threaded=True, capturebody=True):
+    """Create a test server bound to the given host and port.
+
+    If port is iterable, each port in it is tried in turn until one that
+    isn't in use is found.
+    """
+    kwargs = {'shutdownsock': shutdownsock, 'ignorehangups': ignorehangups,
+              'threaded': threaded}
+    if isinstance(port, Iterable):
+        httpd = None
+        for p in port:
+            try:
+                httpd = _TestWSGIServer((host, p), _TestWSGIRequestHandler,
+                                        **kwargs)
+                break
+            except socket.error as e:
+                if e.errno != errno.EADDRINUSE:
+                    raise
+        if httpd is None:
+            raise ValueError('No port available in %r' % port)
+    else:
+        httpd = _TestWSGIServer((host, port), _TestWSGIRequestHandler,
+                                **kwargs)
+
+    if capturelog:
+        app = _LogMiddleware(app, logqueue, maxbodysize, capturebody)
+    httpd.set_app(app)
+    return httpd
+
+def _serve(httpd):
     try:
         httpd.serve_forever()
     finally:
         httpd.server_close()
+        # TestServer.close() waits for this thread, so in-flight requests
+        # are finished (or close() times out) before it returns.
+        httpd.joinrequests()
 
 _servertimeout = 5
 
@@ -269,36 +564,35 @@ class TestServer(object):
     """A test HTTP server"""
 
     def __init__(self, app=nocontent, host='localhost',
-                 port=xrange(30059, 30159), ignorehangups=False):
+                 port=xrange(30059, 30159), ignorehangups=False,
+                 capturelog=True, logmaxsize=10000, maxbodysize=None,
+                 threaded=True, capturebody=True):
         self._host = host
-        self._log = []
-        self._logqueue = Queue()
-        self._shutdownpipe = None
+        self._log = deque(maxlen=logmaxsize)
+        self._logqueue = _LogQueue(logmaxsize)
+        self._shutdownsocks = None
         self._ignorehangups = ignorehangups
+        self._capturelog = capturelog
+        self._maxbodysize = maxbodysize
+        self._threaded = threaded
+        self._capturebody = capturebody
 
-        if isinstance(port, Iterable):
-            p = None
-            for p in port:
-                if _portavailable(self._host, p):
-                    break
-            if p is not None:
-                self._port = p
-            else:
-                raise ValueError('No port available in %r' % port)
-        else:
-            self._port = port
-
-        start = Event()
-        self._shutdownpipe = os.pipe()
-        self._httpd = Thread(target=_makeserver,
-                             args=(self._host, self._port, app,
-                                   self._logqueue, start,
-                                   self._shutdownpipe[0],
-                                   self._ignorehangups))
+        self._shutdownsocks = _socketpair()
+        try:
+            httpd = _makeserver(self._host, port, app, self._logqueue,
+                                self._shutdownsocks[0], self._ignorehangups,
+                                self._capturelog, self._maxbodysize,
+                                self._threaded, self._capturebody)
+        except BaseException:
+            self._shutdownsocks[0].close()
+            self._shutdownsocks[1].close()
+            raise
+        self._port = httpd.server_port
+        self._baseurl = 'http://%s:%s' % (self._host, self._port)
+
+        self._httpd = Thread(target=_serve, args=(httpd,))
         self._httpd.daemon = True
         self._httpd.start()
-        if not start.wait(_servertimeout):
-            raise RuntimeError('Timed out while starting %r' % self)
 
     def __enter__(self):
         return self
@@ -306,15 +600,15 @@ class TestServer(object):
     def close(self):
         """Shut down the HTTP server"""
         if self._httpd is not None:
-            os.write(self._shutdownpipe[1], b's')
+            self._shutdownsocks[1].send(b's')
             self._httpd.join(_servertimeout)
             if self._httpd.is_alive():
                 raise RuntimeError('Timed out while shutting down %r' % self)
             else:
                 self._httpd = None
-                os.close(self._shutdownpipe[0])
-                os.close(self._shutdownpipe[1])
-                self._shutdownpipe = None
+                self._shutdownsocks[0].close()
+                self._shutdownsocks[1].close()
+                self._shutdownsocks = None
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
@@ -328,19 +622,26 @@ class TestServer(object):
         """
         if not path.startswith('/'):
             path = '/' + path
-        return 'http://%s:%s%s' % (self._host, self._port, path)
+        return self._baseurl + path
 
     def log(self):
-        """Return a log of requests and responses"""
-        while True:
-            try:
-                entry = self._logqueue.get(block=False)
-            except Empty:
-                break
-            else:
-                self._log.append(entry)
+        """Return a log of requests and responses.
 
-        return self._log
+        Only the most recent logmaxsize entries are kept.
+        """
+        if not self._capturelog:
+            raise RuntimeError('Logging is disabled for %r' % self)
+
+        for entry in self._logqueue.drain():
+            self._log.append((TestRequest(*entry[:6]),
+                              TestResponse(*entry[6:])))
+        return list(self._log)
+
+    def dropped(self):
+        """Return the number of log entries that were discarded because
+        more than logmaxsize of them were waiting to be collected.
+        """
+        return self._logqueue.dropped
 
 # XXX: Support setting app as a string, 2-tuple (status, body), 3-tuple
 #      (status, headers, body), or dict {url: string/2-tuple/3-tuple}.
@@ -349,14 +650,35 @@ class TestServer(object):
 # XXX: For dicts, how should 404s be handled? Should mapping None set
 #      a catchall? Or should the mapping support globs?
 def testserver(app=nocontent, host='localhost', port=xrange(30059, 30159),
-               ignorehangups=False):
+               ignorehangups=False, capturelog=True, logmaxsize=10000,
+               maxbodysize=None, threaded=True, capturebody=True):
     """Create a test HTTP server from a WSGI app.
 
-    The test server will bind to the given host and port (or port range).
+    The test server will bind to the given host and port (or port range). If
+    port is 0, the operating system picks a free port, which can't clash with
+    other processes binding ports from the same range.
 
     If ignorehangups is True, the server will not log errors caused by clients
     hanging up (closing their connection) early.
 
+    If capturelog is False, requests and responses aren't recorded and
+    server.log() can't be called. This takes the logging middleware out of
+    the request path entirely for tests that don't inspect the log.
+
+    server.log() keeps the most recent logmaxsize entries. If more than that
+    many requests are made between calls to server.log(), the oldest ones
+    are discarded and counted by server.dropped(). If logmaxsize is None,
+    the log is unbounded.
+
+    If maxbodysize is set, request bodies longer than that many bytes aren't
+    recorded (request.body is None) and are passed to the app without being
+    buffered in memory first. If capturebody is False, response bodies aren't
+    recorded either (response.body is None), so streamed responses aren't
+    held in memory for the log.
+
+    Requests are handled concurrently, each in its own thread. If threaded is
+    False, they're handled one at a time in the order they were accepted.
+
     Usage:
 
     >>> import requests
@@ -382,6 +704,38 @@ def testserver(app=nocontent, host='localhost', port=xrange(30059, 30159),
     >>> assert response.headers['content-type'] == 'text/plain'
     >>> assert response.text == u'Hello, test!'
 
+    Apps can also stream their response. It's logged by the time the client
+    has read all of it:
+
+    >>> def streamingapp(environ, start_response):
+    ...     start_response('200 OK', [('Content-type', 'text/plain'),
+    ...                               ('Content-Length', '12')])
+    ...     yield b'Hello, '
+    ...     yield b'test!'
+
+    >>> with testserver(streamingapp) as server:
+    ...     response = requests.get(server.url())
+    ...     log = server.log()
+    >>> assert response.text == u'Hello, test!'
+    >>> assert len(log) == 1
+    >>> assert log[0][1].body == b'Hello, test!'
+
+    Each chunk is sent as soon as the app yields it:
+
+    >>> import threading
+    >>> received = threading.Event()
+    >>> def longpoll(environ, start_response):
+    ...     start_response('200 OK', [('Content-type', 'text/plain')])
+    ...     yield b'first'
+    ...     yield b'second' if received.wait(5) else b'too late'
+
+    >>> with testserver(longpoll) as server:
+    ...     response = requests.get(server.url(), stream=True)
+    ...     first = response.raw.read(5)
+    ...     received.set()
+    ...     rest = response.raw.read()
+    >>> assert (first, rest) == (b'first', b'second')
+
     Nesting is supported:
 
     >>> def app2(environ, start_response):
@@ -394,6 +748,12 @@ def testserver(app=nocontent, host='localhost', port=xrange(30059, 30159),
     >>> assert response1.text == u'Hello, test!'
     >>> assert response2.text == u'Hello again!'
 
+    The port can be left to the operating system:
+
+    >>> with testserver(app, port=0) as server:
+    ...     response = requests.get(server.url())
+    >>> assert response.text == u'Hello, test!'
+
     As is manual starting/shutting down:
 
     >>> server = testserver(app)
@@ -402,5 +762,112 @@ def testserver(app=nocontent, host='localhost', port=xrange(30059, 30159),
     ... finally:
     ...     server.close()
     >>> assert response.text == u'Hello, test!'
+
+    Logging can be turned off for tests that don't need it:
+
+    >>> with testserver(app, capturelog=False) as server:
+    ...     response = requests.get(server.url())
+    >>> assert response.text == u'Hello, test!'
+    >>> server.log() # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+      ...
+    RuntimeError: Logging is disabled for <httptest.TestServer object at ...>
+
+    Only the most recent logmaxsize entries are kept:
+
+    >>> with testserver(logmaxsize=2) as server:
+    ...     for path in ['/1', '/2', '/3']:
+    ...         response = requests.get(server.url(path))
+    >>> assert [request.path for request, _ in server.log()] == ['/2', '/3']
+    >>> assert server.dropped() == 1
+
+    Request bodies over maxbodysize still reach the app, but aren't logged:
+
+    >>> def echo(environ, start_response):
+    ...     size = int(environ['CONTENT_LENGTH'])
+    ...     start_response('200 OK', [('Content-type', 'text/plain')])
+    ...     return [environ['wsgi.input'].read(size)]
+
+    >>> with testserver(echo, maxbodysize=10) as server:
+    ...     response = requests.post(server.url(), data=b'x' * 100)
+    >>> [(request, _)] = server.log()
+    >>> assert request.body is None
+    >>> assert request.headers['content-length'] == '100'
+    >>> assert response.content == b'x' * 100
+
+    Response bodies aren't recorded when capturebody is False, but their length
+    is, even for streamed responses without a Content-Length header:
+
+    >>> def unsizedapp(environ, start_response):
+    ...     start_response('200 OK', [('Content-type', 'text/plain')])
+    ...     yield b'Hello, '
+    ...     yield b'test!'
+
+    >>> with testserver(unsizedapp, capturebody=False) as server:
+    ...     response = requests.get(server.url())
+    >>> [(_, logged)] = server.log()
+    >>> assert logged.body is None
+    >>> assert logged.headers['content-length'] == '12'
+    >>> assert response.text == u'Hello, test!'
+
+    Requests are handled concurrently, so one can wait for another:
+
+    >>> import threading
+    >>> waiting, arrived = threading.Event(), threading.Event()
+    >>> def handshake(environ, start_response):
+    ...     if environ['PATH_INFO'] == '/wait':
+    ...         waiting.set()
+    ...         ok = arrived.wait(5)
+    ...     else:
+    ...         ok = waiting.wait(5)
+    ...         arrived.set()
+    ...     start_response('200 OK' if ok else '504 Gateway Timeout', [])
+    ...     return [b'']
+
+    >>> responses = []
+    >>> with testserver(handshake) as server:
+    ...     waiter = threading.Thread(target=lambda: responses.append(
+    ...         requests.get(server.url('/wait'))))
+    ...     waiter.start()
+    ...     responses.append(requests.get(server.url('/arrive')))
+    ...     waiter.join()
+    >>> assert [r.status_code for r in responses] == [200, 200]
+
+    With threaded=False they're handled one at a time instead:
+
+    >>> import time
+    >>> active = []
+    >>> def serialized(environ, start_response):
+    ...     active.append(None)
+    ...     alone = len(active) == 1
+    ...     time.sleep(0.1)
+    ...     active.pop()
+    ...     start_response('200 OK', [('Content-type', 'text/plain')])
+    ...     return [b'alone' if alone else b'overlapped']
+
+    >>> texts = []
+    >>> with testserver(serialized, threaded=False) as server:
+    ...     clients = [threading.Thread(target=lambda: texts.append(
+    ...         requests.get(server.url()).text)) for _ in range(3)]
+    ...     for client in clients:
+    ...         client.start()
+    ...     for client in clients:
+    ...         client.join()
+    >>> assert texts == [u'alone'] * 3
+
+    Apps can reuse the same header list for every response; the server adds
+    its own headers without modifying it:
+
+    >>> HEADERS = [('Content-type', 'text/plain')]
+    >>> def sharedheaders(environ, start_response):
+    ...     start_response('200 OK', HEADERS)
+    ...     return [b'Hello, test!']
+
+    >>> with testserver(sharedheaders) as server:
+    ...     response1 = requests.get(server.url())
+    ...     response2 = requests.get(server.url())
+    >>> assert HEADERS == [('Content-type', 'text/plain')]
+    >>> assert response2.headers['server'] == 'httptest'
     """
-    return TestServer(app, host, port, ignorehangups)
+    return TestServer(app, host, port, ignorehangups, capturelog, logmaxsize,
+                      maxbodysize, threaded, capturebody)